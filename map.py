@@ -1,8 +1,14 @@
 from typing import List, Self, override
 from abc import abstractmethod
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+import struct
+from urllib.parse import quote
+import json
 import time
 import glob
+import zlib
 import os
 
 from mpmath import mpf, ceil
@@ -11,7 +17,7 @@ from PIL.Image import Image
 
 # Selenium
 # On Arch: python-selenium and geckodriver packages are required
-from selenium.webdriver import Firefox, FirefoxService
+from selenium.webdriver import Firefox, FirefoxOptions, FirefoxService
 from selenium.webdriver.firefox.webdriver import WebDriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -44,6 +50,90 @@ class Position:
     def __str__(self) -> str:
         return f"Position (x = {self.x}, y = {self.y}, z = {self.z})"
 
+class CaptureProfile:
+    '''
+    Firefox preferences and URL-pattern request blocking
+    that cut down what each navigation downloads and renders
+
+    Blocking is done with a PAC script that routes matching requests
+    to a closed local port, so it works without any browser extension
+    '''
+    blocked: list[str]
+    preferences: dict[str, bool | int | str]
+
+    # Lean defaults for capture sessions
+    lean: dict[str, bool | int | str] = {
+        # No animations or smooth scrolling
+        # (the map's own zoom animation is done in JS and is only
+        # affected if the page honours prefers-reduced-motion)
+        "ui.prefersReducedMotion": 1,
+        "toolkit.cosmeticAnimations.enabled": False,
+        "general.smoothScroll": False,
+        # More parallel tile downloads
+        "network.http.max-persistent-connections-per-server": 16,
+        "network.http.max-connections": 1800,
+        # Keep tiles around between frames
+        "browser.cache.memory.enable": True,
+        "browser.cache.memory.capacity": 1048576,
+        "browser.cache.memory.max_entry_size": 65536,
+        # Skip web fonts
+        "gfx.downloadable_fonts.enabled": False,
+        "browser.display.use_document_fonts": 0,
+    }
+
+    # Where blocked requests are sent (discard port, nothing listens there)
+    sink: str = "PROXY 127.0.0.1:9"
+
+    def __init__(self,
+                 blocked: list[str] | None = None,
+                 preferences: dict[str, bool | int | str] | None = None,
+                ):
+        '''
+        `blocked` are shell-style URL patterns (e.g. `*://*.doubleclick.net/*`),
+        `preferences` are added on top of the lean defaults
+        '''
+        self.blocked = [] if blocked is None else list(blocked)
+        self.preferences = self.lean | ({} if preferences is None else preferences)
+
+    def pac_script(self) -> str:
+        '''
+        Proxy auto-config script sending blocked URLs to the sink
+        '''
+        return (
+            "function FindProxyForURL(url, host) {"
+            f" var blocked = {json.dumps(self.blocked)};"
+            " for (var i = 0; i < blocked.length; i++) {"
+            "  if (shExpMatch(url, blocked[i])) {"
+            f"   return {json.dumps(self.sink)};"
+            "  }"
+            " }"
+            " return 'DIRECT';"
+            "}"
+        )
+
+    def options(self) -> FirefoxOptions:
+        '''
+        Firefox options with this profile applied
+        '''
+        options: FirefoxOptions = FirefoxOptions()
+        for (key, value) in self.preferences.items():
+            options.set_preference(key, value)
+
+        if self.blocked:
+            options.set_preference("network.proxy.type", 2)
+            options.set_preference(
+                "network.proxy.autoconfig_url",
+                "data:application/x-ns-proxy-autoconfig," + quote(self.pac_script())
+            )
+            # Match against full HTTPS URLs, not just the origin
+            options.set_preference("network.proxy.autoconfig_url.include_path", True)
+            # Don't fall back to a direct connection for blocked requests
+            options.set_preference("network.proxy.failover_direct", False)
+            # Apply the patterns to a local stand-in page as well
+            options.set_preference("network.proxy.allow_hijacking_localhost", True)
+
+        return options
+
 class Website:
     browser: WebDriver
 
@@ -52,10 +142,19 @@ class Website:
     # NixOS WebDriver executable path
     driver: str = "/run/current-system/sw/bin/geckodriver"
 
-    def __init__(self, browser: WebDriver | None = None):
+    def __init__(self, browser: WebDriver | None = None, profile: CaptureProfile | None = None):
+        '''
+        Start a new Firefox (optionally with a capture profile)
+        unless an existing browser is given
+
+        A profile can only be applied to a newly started Firefox
+        '''
+        assert browser is None or profile is None
+
         if browser is None:
             service: FirefoxService = FirefoxService(executable_path=self.driver)
-            self.browser = Firefox(service=service)
+            options: FirefoxOptions | None = None if profile is None else profile.options()
+            self.browser = Firefox(service=service, options=options)
         else:
             self.browser = browser
 
@@ -141,6 +240,28 @@ class Website:
         raise NotImplementedError()
 
 class MapyCZ(Website):
+    # Map page, can be pointed to `standin.html` for testing
+    url: str = "https://mapy.cz/turisticka"
+
+    # Third-party analytics, ad and font requests
+    # (Mapy.cz's own POI and sidebar requests are not blocked)
+    blocked: list[str] = [
+        "*://*.google-analytics.com/*",
+        "*://*.googletagmanager.com/*",
+        "*://*.doubleclick.net/*",
+        "*://*.imedia.cz/*",
+        "*://h.seznam.cz/*",
+        "*://fonts.gstatic.com/*",
+        "*://fonts.googleapis.com/*",
+    ]
+
+    @classmethod
+    def capture_profile(cls) -> CaptureProfile:
+        '''
+        Lean profile blocking third-party analytics, ads and fonts
+        '''
+        return CaptureProfile(cls.blocked)
+
     def hide_ui(self):
         '''
         Hide the UI elements of the website
@@ -224,7 +345,7 @@ class MapyCZ(Website):
         '''
         Convert a Position to the corresponding website URL
         '''
-        return f"https://mapy.cz/turisticka?l=0&x={pos.x}&y={pos.y}&z={pos.z}"
+        return f"{self.url}?l=0&x={pos.x}&y={pos.y}&z={pos.z}"
 
     @override
     def url_to_pos(self, url: str) -> Position:
@@ -250,8 +371,237 @@ class MapyCZ(Website):
         return pos
 
 
+class Encoder:
+    '''
+    Saves the final stitched image
+    '''
+
+    @abstractmethod
+    def save(self, img: Image, name: Path) -> Path:
+        '''
+        Encode the image to the specified location
+        and return the path of the result
+        '''
+        raise NotImplementedError()
+
+class PillowEncoder(Encoder):
+    '''
+    Plain single-threaded `Image.save`
+    '''
+
+    @override
+    def save(self, img: Image, name: Path) -> Path:
+        img.save(name)
+        return name
+
+class ParallelPNGEncoder(Encoder):
+    '''
+    Compresses independent row bands of the image on all cores
+    and joins them into one valid PNG stream
+
+    Rows are stored unfiltered (filter type 0)
+    '''
+    level: int
+    band_height: int
+    workers: int | None
+
+    # PNG colour types for the supported image modes
+    color_types: dict[str, int] = {
+        "L": 0,
+        "RGB": 2,
+        "RGBA": 6,
+    }
+
+    def __init__(self, level: int = 6, band_height: int = 256, workers: int | None = None):
+        '''
+        `level` is the zlib compression level (1 = fastest, 9 = smallest),
+        `workers` defaults to the number of cores
+        '''
+        assert 0 <= level <= 9
+        assert band_height > 0
+
+        self.level = level
+        self.band_height = band_height
+        self.workers = workers
+
+    @staticmethod
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        '''
+        Build a PNG chunk (length, type, data, CRC)
+        '''
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    @staticmethod
+    def adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+        '''
+        Adler-32 of two concatenated buffers
+        from the checksums of each of them
+        '''
+        base = 65521
+        a1, b1 = adler1 & 0xffff, adler1 >> 16
+        a2, b2 = adler2 & 0xffff, adler2 >> 16
+
+        a = (a1 + a2 - 1) % base
+        b = (b1 + b2 + len2 * (a1 - 1)) % base
+        return (b << 16) | a
+
+    def compress_band(self, img: Image, top: int, last: bool) -> tuple[bytes, int, int]:
+        '''
+        Deflate one band of rows (each prefixed with filter type 0)
+
+        Every band except the last one ends with a sync flush
+        so the raw deflate streams can simply be concatenated
+        '''
+        bottom: int = min(top + self.band_height, img.height)
+        pixels: bytes = img.crop((0, top, img.width, bottom)).tobytes()
+        stride: int = len(pixels) // (bottom - top)
+
+        raw: bytes = b"".join(
+            b"\x00" + pixels[i:i + stride] for i in range(0, len(pixels), stride)
+        )
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        data: bytes = compressor.compress(raw)
+        data += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+        return (data, zlib.adler32(raw), len(raw))
+
+    @override
+    def save(self, img: Image, name: Path) -> Path:
+        if img.mode not in self.color_types:
+            img = img.convert("RGB")
+        color_type: int = self.color_types[img.mode]
+
+        tops: list[int] = list(range(0, img.height, self.band_height))
+        # Only keep a few bands per worker in flight,
+        # so the compressed output doesn't pile up in memory
+        window: int = 2 * (self.workers or os.cpu_count() or 1)
+
+        with open(name, "wb") as file, ThreadPoolExecutor(self.workers) as pool:
+            file.write(b"\x89PNG\r\n\x1a\n")
+            file.write(self.chunk(b"IHDR", struct.pack(
+                ">IIBBBBB", img.width, img.height, 8, color_type, 0, 0, 0
+            )))
+
+            # zlib header (deflate, 32K window, default compression)
+            file.write(self.chunk(b"IDAT", b"\x78\x9c"))
+
+            # Write the bands in order as they finish
+            adler: int = 1
+            pending: deque[Future[tuple[bytes, int, int]]] = deque()
+            last: int = len(tops) - 1
+            for (i, top) in enumerate(tops):
+                pending.append(pool.submit(self.compress_band, img, top, i == last))
+
+                # Drain the window, or everything after the last band
+                while len(pending) >= window or (pending and i == last):
+                    (data, band_adler, band_len) = pending.popleft().result()
+                    file.write(self.chunk(b"IDAT", data))
+                    adler = self.adler32_combine(adler, band_adler, band_len)
+
+            file.write(self.chunk(b"IDAT", struct.pack(">I", adler)))
+
+            file.write(self.chunk(b"IEND", b""))
+
+        return name
+
+class TiledEncoder(Encoder):
+    '''
+    Splits the image into square tiles encoded in parallel
+    and stores them in a folder next to the requested name
+    (e.g. `map.png` -> `map_tiles/tile-{y}-{x}.webp`)
+    '''
+    fmt: str
+    tile_size: int
+    quality: int
+    speed: int
+    workers: int | None
+
+    extensions: dict[str, str] = {
+        "WEBP": "webp",
+        "JPEG": "jpg",
+        "PNG": "png",
+    }
+
+    def __init__(self,
+                 fmt: str = "WEBP",
+                 tile_size: int = 2048,
+                 quality: int = 85,
+                 speed: int = 4,
+                 workers: int | None = None,
+                ):
+        '''
+        `speed` trades encoding time for size:
+        0 = smallest, 6 = fastest (WebP method / PNG level),
+        JPEG only runs the optimizer for speeds below 4
+        '''
+        fmt = fmt.upper()
+        assert fmt in self.extensions
+        assert tile_size > 0
+        assert 0 <= speed <= 6
+
+        self.fmt = fmt
+        self.tile_size = tile_size
+        self.quality = quality
+        self.speed = speed
+        self.workers = workers
+
+    def options(self) -> dict[str, int | bool]:
+        '''
+        Pillow save options for the selected format
+        '''
+        match self.fmt:
+            case "WEBP":
+                return {"quality": self.quality, "method": 6 - self.speed}
+            case "JPEG":
+                return {"quality": self.quality, "optimize": self.speed < 4}
+            case "PNG":
+                return {"compress_level": max(1, 9 - self.speed)}
+            case _:
+                raise ValueError(f"Unsupported tile format {self.fmt}")
+
+    def save_tile(self, img: Image, x: int, y: int, folder: Path) -> Path:
+        '''
+        Crop and encode a single tile
+        '''
+        left: int = x * self.tile_size
+        top: int = y * self.tile_size
+        tile: Image = img.crop((left,
+                                top,
+                                min(left + self.tile_size, img.width),
+                                min(top + self.tile_size, img.height)))
+
+        path: Path = folder / f"tile-{y}-{x}.{self.extensions[self.fmt]}"
+        tile.save(path, self.fmt, **self.options())
+        return path
+
+    @override
+    def save(self, img: Image, name: Path) -> Path:
+        if self.fmt == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+
+        folder: Path = name.parent / f"{name.stem}_tiles"
+        folder.mkdir(parents=True, exist_ok=True)
+
+        # Remove tiles of a previous run (possibly of a different
+        # size or format) so they don't get mixed with the new ones
+        for ext in self.extensions.values():
+            for old in folder.glob(f"tile-*.{ext}"):
+                old.unlink()
+
+        tiles: list[tuple[int, int]] = [
+            (x, y)
+            for y in range(0, -(-img.height // self.tile_size))
+            for x in range(0, -(-img.width // self.tile_size))
+        ]
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(lambda tile: self.save_tile(img, tile[0], tile[1], folder), tiles))
+
+        return folder
+
 class MapBuilder:
     website: Website
+    encoder: Encoder
 
     # Top-left position
     start: Position
@@ -268,6 +618,7 @@ class MapBuilder:
                  height: mpf,
                  u_shift: mpf,
                  r_shift: mpf,
+                 encoder: Encoder | None = None,
                 ):
         self.website = website
         self.start = start
@@ -275,6 +626,7 @@ class MapBuilder:
         self.height = height
         self.u_shift = u_shift
         self.r_shift = r_shift
+        self.encoder = ParallelPNGEncoder() if encoder is None else encoder
 
     @staticmethod
     def get_shift(website: Website) -> tuple[Position, mpf, mpf]:
@@ -454,7 +806,7 @@ class MapBuilder:
 
         return path
 
-    def assemble(self, pictures: list[list[str]], name: Path):
+    def assemble(self, pictures: list[list[str]], name: Path) -> Path:
         '''
         Assemble frames into one picture
         '''
@@ -488,8 +840,7 @@ class MapBuilder:
             # TODO: Adjusting on only 3-5 sample images
             cont = input("Do you want to adjust?").lower()
             if cont == 'n':
-                full_img.save(name)
-                break
+                return self.encoder.save(full_img, name)
 
     def build(self):
         # TODO: Temporary folder
@@ -543,15 +894,15 @@ class MapBuilder:
 
         print("Assembling frames into a map ...")
         name: Path = Path("map.png")
-        self.assemble(pictures, name)
+        output: Path = self.assemble(pictures, name)
 
-        print(f"Final map: {name}")
+        print(f"Final map: {output}")
 
     def close(self):
         self.website.close()
 
 if __name__ == "__main__":
-    website: Website = MapyCZ()
+    website: Website = MapyCZ(profile=MapyCZ.capture_profile())
     builder: MapBuilder = MapBuilder.from_box(website)
 
     # Default